@@ -0,0 +1,178 @@
+import os.path
+import tempfile
+import unittest
+from io import BytesIO
+from unittest import mock
+
+from graph_db import (IO_BUFFER_SIZE, build_vertex_db,
+                      build_vertex_db_parallel, edge_rec, index_rec)
+
+TEST_SRC=b"""1	6,7
+4	9
+5	4
+6	4
+7	9
+9	1,4,5
+"""
+
+
+class TestVertedDB(unittest.TestCase):
+    def test_build_vertex_db(self):
+        src = BytesIO(TEST_SRC)
+        with tempfile.TemporaryDirectory() as tempdir:
+            al_ix_path = os.path.join(tempdir, 'al_ix')
+            al_file_path = os.path.join(tempdir, 'al')
+            al_ix_file = open(al_ix_path, 'wb')
+            al_file = open(al_file_path, 'wb', buffering=0)
+            build_vertex_db(src, al_ix_file, al_file, progress=False)
+
+            # assertions
+            self.assertEqual(edge_rec.size, 4, "edge rec should be 32 bits")
+            self.assertEqual(index_rec.size, 8, "index rec should be 64 bits")
+            with open(al_ix_path, 'rb', buffering=IO_BUFFER_SIZE) as al_ix_file:
+                al_ix_data = al_ix_file.read()
+            with open(al_file_path, 'rb', buffering=IO_BUFFER_SIZE) as al_file:
+                al_data = al_file.read()
+
+            (magic,) = edge_rec.unpack(al_data[0:4])
+            self.assertEqual(1337, magic, "first record in al should be 1337")
+            (vertex_0_ix,) = index_rec.unpack(al_ix_data[0:index_rec.size])
+            self.assertEqual(vertex_0_ix, 0, "al_ix should have no header")
+            # 1 should point to 6 and 7
+            (vertex_1_ix,) = index_rec.unpack(
+                al_ix_data[(index_rec.size*1):(index_rec.size*2)]
+            )
+            (vertex_1_edge_1,) = edge_rec.unpack(
+                al_data[vertex_1_ix:(vertex_1_ix+edge_rec.size)]
+            )
+            self.assertEqual(vertex_1_edge_1, 6,
+                             "first edge of vertex 1 should point to 6")
+            vertex_1_ix += edge_rec.size
+            (vertex_1_edge_2,) = edge_rec.unpack(
+                al_data[vertex_1_ix:(vertex_1_ix+edge_rec.size)]
+            )
+            self.assertEqual(vertex_1_edge_2, 7,
+                             "second edge of vertex 1 should point to 7")
+            vertex_1_ix += edge_rec.size
+            (vertex_1_edge_null,) = edge_rec.unpack(
+                al_data[vertex_1_ix:(vertex_1_ix+edge_rec.size)]
+            )
+            self.assertEqual(vertex_1_edge_null, 0,
+                             "vertex 1 should have null terminator after second edge")
+
+    def test_vertex_without_edges(self):
+        src = BytesIO(b"2\t\n3\t2\n4\t\r\n5\t3\r\n")
+        with tempfile.TemporaryDirectory() as tempdir:
+            al_ix_path = os.path.join(tempdir, 'al_ix')
+            al_file_path = os.path.join(tempdir, 'al')
+            al_ix_file = open(al_ix_path, 'wb')
+            al_file = open(al_file_path, 'wb', buffering=0)
+            build_vertex_db(src, al_ix_file, al_file, progress=False)
+
+            with open(al_ix_path, 'rb') as f:
+                al_ix_data = f.read()
+            self.assertEqual(len(al_ix_data), index_rec.size * 6,
+                             "index should have an entry for each id up to 5")
+            (vertex_2_ix,) = index_rec.unpack(
+                al_ix_data[(index_rec.size*2):(index_rec.size*3)]
+            )
+            self.assertEqual(vertex_2_ix, 0,
+                             "vertex 2 has no edges and should have no list")
+            (vertex_3_ix,) = index_rec.unpack(
+                al_ix_data[(index_rec.size*3):(index_rec.size*4)]
+            )
+            self.assertEqual(vertex_3_ix, edge_rec.size,
+                             "vertex 3 should have the first list after the magic")
+            (vertex_4_ix,) = index_rec.unpack(
+                al_ix_data[(index_rec.size*4):(index_rec.size*5)]
+            )
+            self.assertEqual(vertex_4_ix, 0,
+                             "vertex 4 has no edges (crlf) and should have no list")
+            (vertex_5_ix,) = index_rec.unpack(
+                al_ix_data[(index_rec.size*5):(index_rec.size*6)]
+            )
+            self.assertEqual(vertex_5_ix, edge_rec.size * 3,
+                             "vertex 5 should have the list after vertex 3")
+
+    def test_build_vertex_db_parallel(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            src_path = os.path.join(tempdir, 'src')
+            with open(src_path, 'wb') as f:
+                f.write(TEST_SRC)
+            outputs = []
+            for jobs in (1, 3):
+                al_ix_path = os.path.join(tempdir, f'al_ix.{jobs}')
+                al_file_path = os.path.join(tempdir, f'al.{jobs}')
+                al_ix_file = open(al_ix_path, 'wb')
+                if jobs == 1:
+                    al_file = open(al_file_path, 'wb', buffering=0)
+                    with open(src_path, 'rb') as src:
+                        build_vertex_db(src, al_ix_file, al_file, progress=False)
+                else:
+                    al_file = open(al_file_path, 'wb', buffering=IO_BUFFER_SIZE)
+                    build_vertex_db_parallel(src_path, al_ix_file, al_file,
+                                             jobs, progress=False)
+                with open(al_ix_path, 'rb') as f_ix, open(al_file_path, 'rb') as f_al:
+                    outputs.append((f_ix.read(), f_al.read()))
+            self.assertEqual(outputs[0], outputs[1],
+                             "sharded build should match a serial build")
+
+    def test_edge_out_of_range(self):
+        for edge in (b"4294967296", b"4294967297"):
+            src = BytesIO(b"1\t2," + edge + b",3\n")
+            with tempfile.TemporaryDirectory() as tempdir:
+                al_ix_file = open(os.path.join(tempdir, 'al_ix'), 'wb')
+                al_file = open(os.path.join(tempdir, 'al'), 'wb', buffering=0)
+                with self.assertRaises(ValueError,
+                                       msg="edge ids over 32 bits should be rejected"):
+                    build_vertex_db(src, al_ix_file, al_file, progress=False)
+                al_ix_file.close()
+                al_file.close()
+
+    def test_vertex_past_max_vertex(self):
+        src = BytesIO(b"1\t2\n10\t1\n")
+        with tempfile.TemporaryDirectory() as tempdir:
+            al_ix_path = os.path.join(tempdir, 'al_ix')
+            al_ix_file = open(al_ix_path, 'wb')
+            al_file = open(os.path.join(tempdir, 'al'), 'wb', buffering=0)
+            with mock.patch('graph_db.MAX_VERTEX', 4):
+                build_vertex_db(src, al_ix_file, al_file, progress=False)
+
+            with open(al_ix_path, 'rb') as f:
+                al_ix_data = f.read()
+            self.assertEqual(len(al_ix_data), index_rec.size * 11,
+                             "index should grow to cover ids past MAX_VERTEX")
+            (vertex_10_ix,) = index_rec.unpack(al_ix_data[-index_rec.size:])
+            self.assertEqual(vertex_10_ix, edge_rec.size * 3,
+                             "vertex 10 should have the list after vertex 1")
+
+    def test_build_vertex_db_parallel_unsorted(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            src_path = os.path.join(tempdir, 'src')
+            with open(src_path, 'wb') as f:
+                # each half is sorted; the split falls after vertex 7
+                f.write(b"5\t1\n6\t2\n7\t3,4,5,6\n1\t4\n2\t5\n")
+            al_ix_file = open(os.path.join(tempdir, 'al_ix'), 'wb')
+            al_file = open(os.path.join(tempdir, 'al'), 'wb')
+            with self.assertRaisesRegex(AssertionError, "vertex 1 follows 7",
+                                        msg="unsorted input across shards should be caught"):
+                build_vertex_db_parallel(src_path, al_ix_file, al_file,
+                                         2, progress=False)
+            al_ix_file.close()
+            al_file.close()
+
+    def test_edge_empty_or_zero(self):
+        for edges in (b"2,3,", b"2,,3", b"2,0,3"):
+            src = BytesIO(b"1\t" + edges + b"\n")
+            with tempfile.TemporaryDirectory() as tempdir:
+                al_ix_file = open(os.path.join(tempdir, 'al_ix'), 'wb')
+                al_file = open(os.path.join(tempdir, 'al'), 'wb', buffering=0)
+                with self.assertRaises(ValueError,
+                                       msg="empty or 0 edge ids should be rejected"):
+                    build_vertex_db(src, al_ix_file, al_file, progress=False)
+                al_ix_file.close()
+                al_file.close()
+
+
+if __name__ == '__main__':
+    unittest.main()